@@ -1,13 +1,28 @@
 #!/usr/bin/env python3
 # SPDX-License-Identifier: GPL-2.0
 
+from concurrent.futures import ThreadPoolExecutor
 import configparser
 import datetime
+import hashlib
 import json
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import threading
 import time
 
+try:
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(data):
+        return json.dumps(data).encode('utf-8')
 
 """
 Config:
@@ -23,110 +38,205 @@ combined=name-of-manifest.json
 """
 
 
+class FetcherState:
+    def __init__(self):
+        self.config = configparser.ConfigParser()
+        self.config.read(['fetcher.config'])
+
+        self.out_dir = self.config.get('output', 'dir')
+        self.url_pfx = self.config.get('output', 'url_pfx')
+        self.combined = os.path.join(self.out_dir, self.config.get('output', 'combined'))
+        self.branch_url = self.config.get('input', 'branch_url')
+        self.remote_db = self.config.get('input', 'remote_db')
+        self.refresh = int(self.config.get('cfg', 'refresh'))
+
+        # Share one session so that connections to the remotes are kept alive
+        self.http = requests.Session()
+        retry = Retry(total=3, backoff_factor=0.2)
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=retry)
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+
+        # Per-remote state, see build_seen()
+        self.seen = {}
+        # Parsed run results, file path -> (mtime, size, data)
+        self.combine_cache = {}
+        # Cache gets seeded by fetches while combine may be running
+        self.combine_lock = threading.Lock()
+
+
+def digest(buf):
+    return hashlib.blake2b(buf, digest_size=16).digest()
+
+
 def write_json_atomic(path, data):
+    write_atomic(path, json_dumps(data))
+
+
+def write_atomic(path, buf):
     tmp = path + '.new'
-    with open(tmp, 'w') as fp:
-        json.dump(data, fp)
-    os.rename(tmp, path)
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        buf = memoryview(buf)
+        while buf:
+            buf = buf[os.write(fd, buf):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
 
 
-def fetch_remote_run(run_info, remote_state):
-    r = requests.get(run_info['url'])
-    data = json.loads(r.content.decode('utf-8'))
+def fetch_remote_run(fetcher, run_info, remote_state):
+    r = fetcher.http.get(run_info['url'])
+    data = json_loads(r.content)
 
     file = os.path.join(remote_state['dir'], os.path.basename(run_info['url']))
-    with open(file, "w") as fp:
-        json.dump(data, fp)
+    with open(file, "wb") as fp:
+        fp.write(json_dumps(data))
+
+    # Seed the combine cache, we already have the data parsed
+    st = os.stat(file)
+    with fetcher.combine_lock:
+        fetcher.combine_cache[file] = (st.st_mtime, st.st_size, data)
 
 
-def fetch_remote(remote, seen):
+def fetch_remote(fetcher, remote):
     print("Fetching remote", remote['url'])
-    r = requests.get(remote['url'])
-    manifest = json.loads(r.content.decode('utf-8'))
-    remote_state = seen[remote['name']]
+    r = fetcher.http.get(remote['url'])
+    manifest = json_loads(r.content)
+    remote_state = fetcher.seen[remote['name']]
 
     fetched = False
+    pending = []
+    wip = set()
     for run in manifest:
         if run['branch'] in remote_state['seen']:
             continue
         if not run['url']:    # Executor has not finished, yet
             fetched |= run['branch'] not in remote_state['wip']
+            wip.add(run['branch'])
             continue
 
         print('Fetching run', run['branch'])
-        fetch_remote_run(run, remote_state)
-        fetched = True
+        pending.append(run)
 
-    with open(os.path.join(remote_state['dir'], 'results.json'), "w") as fp:
-        json.dump(manifest, fp)
+    if pending:
+        with ThreadPoolExecutor(max_workers=8) as ex:
+            # list() to wait for completion and re-raise any exceptions
+            list(ex.map(lambda run: fetch_remote_run(fetcher, run, remote_state), pending))
+        fetched = True
+    # Update the state in place, no need to re-read everything from disk
+    for run in pending:
+        remote_state['seen'].add(run['branch'])
+    remote_state['wip'] = wip
+
+    # Most of the time nothing changed, don't rewrite the file
+    buf = json_dumps(manifest)
+    buf_digest = digest(buf)
+    if buf_digest != remote_state['manifest_digest']:
+        write_atomic(remote_state['manifest_path'], buf)
+        remote_state['manifest_digest'] = buf_digest
+    remote_state['manifest'] = manifest
 
     return fetched
 
 
-def build_combined(config, remote_db):
-    r = requests.get(config.get('input', 'branch_url'))
-    branches = json.loads(r.content.decode('utf-8'))
+def load_run_result(fetcher, file, used):
+    st = os.stat(file)
+    used.add(file)
+
+    cached = fetcher.combine_cache.get(file)
+    if cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+        return cached[2].copy()
+
+    with open(file, "rb") as fp:
+        data = json_loads(fp.read())
+    fetcher.combine_cache[file] = (st.st_mtime, st.st_size, data)
+    return data.copy()
+
+
+def build_combined(fetcher, remote_db):
+    # Fetches may seed the cache while we combine from older manifests,
+    # only consider evicting what was cached before we started
+    with fetcher.combine_lock:
+        cached = set(fetcher.combine_cache.keys())
+
+    r = fetcher.http.get(fetcher.branch_url)
+    branches = json_loads(r.content)
     branch_info = {}
     for br in branches:
         branch_info[br['branch']] = br
 
     combined = []
+    used = set()
     for remote in remote_db:
         name = remote['name']
-        dir = os.path.join(config.get('output', 'dir'), name)
+        remote_state = fetcher.seen[name]
+        dir = remote_state['dir']
         print('Combining from remote', name)
 
-        manifest = os.path.join(dir, 'results.json')
-        if not os.path.exists(manifest):
+        results = remote_state['manifest']
+        if results is None:
             continue
 
-        with open(manifest, "r") as fp:
-            results = json.load(fp)
-
         for entry in results:
             if not entry['url']:    # Executor is running
                 if entry['branch'] not in branch_info:
                     continue
-                data = entry.copy()
                 when = datetime.datetime.fromisoformat(branch_info[entry['branch']]['date'])
-                data["start"] = str(when)
-                when += datetime.timedelta(hours=2, minutes=58)
-                data["end"] = str(when)
-                data["results"] = None
+                data = {
+                    "branch": entry['branch'],
+                    "executor": entry.get('executor'),
+                    "start": str(when),
+                    "end": str(when + datetime.timedelta(hours=2, minutes=58)),
+                    "results": None,
+                }
             else:
                 file = os.path.join(dir, os.path.basename(entry['url']))
-                if not os.path.exists(file):
+                try:
+                    data = load_run_result(fetcher, file, used)
+                except FileNotFoundError:
                     print('No file', file)
                     continue
-                with open(file, "r") as fp:
-                    data = json.load(fp)
 
             data['remote'] = name
             combined.append(data)
+
+    # Drop results which are no longer referenced by any manifest
+    with fetcher.combine_lock:
+        for file in cached - used:
+            del fetcher.combine_cache[file]
+
     return combined
 
 
-def build_seen(config, remote_db):
-    seen = {}
+def build_seen(fetcher, remote_db):
+    seen = fetcher.seen
     for remote in remote_db:
-        seen[remote['name']] = {'seen': set(), 'wip': set()}
+        seen[remote['name']] = {'seen': set(), 'wip': set(),
+                                 'manifest': None, 'manifest_digest': None}
 
         # Prepare local state
         name = remote['name']
-        dir = os.path.join(config.get('output', 'dir'), name)
+        dir = os.path.join(fetcher.out_dir, name)
         seen[name]['dir'] = dir
         os.makedirs(dir, exist_ok=True)
 
-        url = config.get('output', 'url_pfx') + '/' + name
+        url = fetcher.url_pfx + '/' + name
         seen[name]['url'] = url
 
-        # Read the files
         manifest = os.path.join(dir, 'results.json')
-        if not os.path.exists(manifest):
-            continue
+        seen[name]['manifest_path'] = manifest
 
-        with open(manifest, "r") as fp:
-            results = json.load(fp)
+        # Read the files
+        try:
+            with open(manifest, "rb") as fp:
+                buf = fp.read()
+        except FileNotFoundError:
+            continue
+        results = json_loads(buf)
+        seen[name]['manifest'] = results
+        seen[name]['manifest_digest'] = digest(buf)
         for entry in results:
             if not entry.get('url'):
                 seen[name]['wip'].add(entry.get('branch'))
@@ -136,39 +246,52 @@ def build_seen(config, remote_db):
             if not os.path.exists(file):
                 continue
             seen[name]['seen'].add(entry.get('branch'))
-    return seen
 
 
-def one_check(config, remote_db, seen):
-    fetched = False
-    for remote in remote_db:
-        fetched |= fetch_remote(remote, seen)
-    return fetched
-
+def combine_and_write(fetcher, remote_db):
+    print('Generating combined')
+    results = build_combined(fetcher, remote_db)
+    write_json_atomic(fetcher.combined, results)
 
-def main() -> None:
-    config = configparser.ConfigParser()
-    config.read(['fetcher.config'])
 
-    with open(config.get('input', 'remote_db'), "r") as fp:
-        remote_db = json.load(fp)
+def one_check(fetcher, remote_db):
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        results = ex.map(lambda remote: fetch_remote(fetcher, remote), remote_db)
+        return any(list(results))
 
-    fetched = True
-    while True:
-        if fetched:
-            seen = build_seen(config, remote_db)
 
-        fetched = one_check(config, remote_db, seen)
+def main() -> None:
+    fetcher = FetcherState()
 
-        if fetched:
-            print('Generating combined')
-            results = build_combined(config, remote_db)
+    with open(fetcher.remote_db, "rb") as fp:
+        remote_db = json_loads(fp.read())
 
-            combined = os.path.join(config.get('output', 'dir'),
-                                    config.get('output', 'combined'))
-            write_json_atomic(combined, results)
+    build_seen(fetcher, remote_db)
 
-        time.sleep(int(config.get('cfg', 'refresh')))
+    combiner = ThreadPoolExecutor(max_workers=1)
+    combine_job = None
+    need_combine = False
+    idle = 0
+    while True:
+        fetched = one_check(fetcher, remote_db)
+        need_combine |= fetched
+
+        # Only one combine at a time, if one is still running pick up
+        # the new results once it's done
+        if combine_job and combine_job.done():
+            combine_job.result()
+            combine_job = None
+        if need_combine and not combine_job:
+            combine_job = combiner.submit(combine_and_write, fetcher, remote_db)
+            need_combine = False
+
+        # Back off when remotes are quiet, go back to normal on activity
+        if fetched or need_combine:
+            idle = 0
+        time.sleep(min(fetcher.refresh * 1.5 ** idle, fetcher.refresh * 8))
+        if not fetched:
+            # 1.5 ** 6 is past the 8x cap, no point counting further
+            idle = min(idle + 1, 6)
 
 
 if __name__ == "__main__":
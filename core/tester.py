@@ -17,12 +17,11 @@ def write_tree_selection_result(result_dir, s, comment):
     series_dir = os.path.join(result_dir, str(s.id))
 
     tree_test_dir = os.path.join(series_dir, "tree_selection")
-    if not os.path.exists(tree_test_dir):
-        os.makedirs(tree_test_dir)
+    os.makedirs(tree_test_dir, exist_ok=True)
 
-    with open(os.path.join(tree_test_dir, "retcode"), "w+") as fp:
+    with open(os.path.join(tree_test_dir, "retcode"), "w") as fp:
         fp.write("0")
-    with open(os.path.join(tree_test_dir, "desc"), "w+") as fp:
+    with open(os.path.join(tree_test_dir, "desc"), "w") as fp:
         fp.write(comment)
 
     for patch in s.patches:
@@ -33,8 +32,10 @@ def write_tree_selection_result(result_dir, s, comment):
 
 def mark_done(result_dir, series):
     series_dir = os.path.join(result_dir, str(series.id))
-    if not os.path.exists(os.path.join(series_dir, ".tester_done")):
-        os.mknod(os.path.join(series_dir, ".tester_done"))
+    try:
+        open(os.path.join(series_dir, ".tester_done"), "xb").close()
+    except FileExistsError:
+        pass
 
 
 class Tester(threading.Thread):
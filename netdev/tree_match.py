@@ -9,9 +9,16 @@ import re
 from core import log, log_open_sec, log_end_sec
 
 
+_TREE_NAME_RES = [(t, re.compile(r'\[.*{pfx}.*\]'.format(pfx=t)))
+                  for t in ['net-next', 'net', 'bpf-next', 'bpf']]
+_R_DIFFSTAT = re.compile(r'^\s*([-\w/._]+)\s+\|\s+\d+\s*[-+]*\s*$')
+_R_HEADER = re.compile(r'\+\+\+ b/([-\w/._]+)$')
+_R_FIXES = re.compile(r'^Fixes: [a-f0-9]* \(')
+
+
 def series_tree_name_direct(series):
-    for t in ['net-next', 'net', 'bpf-next', 'bpf']:
-        if re.match(r'\[.*{pfx}.*\]'.format(pfx=t), series.subject):
+    for t, regex in _TREE_NAME_RES:
+        if regex.match(series.subject):
             return t
 
 
@@ -71,12 +78,10 @@ def _tree_name_should_be_local_files(raw_email):
     foreign_found = False
 
     lines = raw_email.split('\n')
-    r_diffstat = re.compile(r'^\s*([-\w/._]+)\s+\|\s+\d+\s*[-+]*\s*$')
-    r_header = re.compile(r'\+\+\+ b/([-\w/._]+)$')
     for line in lines:
-        match = r_header.match(line)
+        match = _R_HEADER.match(line)
         if not match:
-            match = r_diffstat.match(line)
+            match = _R_DIFFSTAT.match(line)
         if not match:
             continue
 
@@ -154,9 +159,8 @@ def series_ignore_missing_tree_name(series):
 
 def series_is_a_fix_for(s, tree):
     commits = []
-    regex = re.compile(r'^Fixes: [a-f0-9]* \(')
     for p in s.patches:
-        commits += regex.findall(p.raw_patch)
+        commits += _R_FIXES.findall(p.raw_patch)
     for c in commits:
         if not tree.contains(c):
             return False
@@ -30,7 +30,8 @@ class PatchworkPostException(Exception):
 class Patchwork(object):
     def __init__(self, config):
         self._session = requests.Session()
-        retry = Retry(connect=10, backoff_factor=1)
+        retry = Retry(connect=10, status=5, backoff_factor=1,
+                      status_forcelist=[502, 503, 504])
         adapter = HTTPAdapter(max_retries=retry)
         self._session.mount('http://', adapter)
         self._session.mount('https://', adapter)